@@ -2,20 +2,112 @@ import os
 import re
 import time
 import shutil
-from pdfminer.high_level import extract_text
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from io import StringIO
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+_FINAL_DIR = Path('final-output')
+_ERROR_DIR = Path('ERROR')
+
+# Patterns are compiled once at import time instead of on every file/match
+_FINDALL_RE = re.compile(r'(?:P0|PO|SPO|RNWS|SGR|SSR) ?\d?-?\d{1,2}-\d{1,4}', re.IGNORECASE)
+_PARTS_RE = re.compile(r'([A-Z]+)(\d?)-(\d{1,2})-(\d{1,4})')
+# Misread three-character prefixes and their replacement
+_PREFIX_FIX = {'P0-': 'PO', 'PQ-': 'PO'}
+
+# Stop reading a document once this many distinct matches were found, or
+# after this many pages without a new match following the first one
+MAX_MATCHES = 8
+MAX_PAGES_WITHOUT_NEW_MATCH = 5
+
+# Number of files processed at the same time
+WORKERS = 2
+
+# How often and how many times to check that a new file is fully written
+POLL_FILE_READY_SECONDS = 0.5
+RETRIES_FILE_READY = 10
+
+
+def wait_for_file_ready(path):
+    # ocrmypdf writes its output in place, so the created event can fire
+    # before the file is complete. Wait until its size stops changing.
+    last_size = -1
+    for _ in range(RETRIES_FILE_READY):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            size = -1
+        if size > 0 and size == last_size:
+            return True
+        last_size = size
+        time.sleep(POLL_FILE_READY_SECONDS)
+    return False
+
+
+def iter_page_texts(path):
+    # Same extraction as pdfminer's extract_text, but one page at a time
+    # so that callers can stop before the whole document is read
+    resource_manager = PDFResourceManager()
+    output = StringIO()
+    with open(path, 'rb') as fp, TextConverter(resource_manager, output, laparams=LAParams()) as device:
+        interpreter = PDFPageInterpreter(resource_manager, device)
+        for page in PDFPage.get_pages(fp):
+            interpreter.process_page(page)
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+
+
+def find_matches(path):
+    # Autocorrected matches without duplicates, in order of appearance
+    matches = {}
+    pages_without_new_match = 0
+    for text in iter_page_texts(path):
+        previous_count = len(matches)
+        for match in _FINDALL_RE.findall(text):
+            matches[autocorrect_match(match.upper())] = None
+
+        if len(matches) > previous_count:
+            pages_without_new_match = 0
+        elif matches:
+            pages_without_new_match += 1
+
+        if len(matches) >= MAX_MATCHES or pages_without_new_match >= MAX_PAGES_WITHOUT_NEW_MATCH:
+            break
+    return list(matches)
+
+
+def reserve_final_name(directory, final_name):
+    # Atomically create an empty placeholder for the first free name, adding
+    # a number between parenthesis if the name is already taken. O_EXCL makes
+    # this safe against another process picking the same name.
+    candidate = final_name
+    num = 0
+    while True:
+        try:
+            fd = os.open(os.path.join(directory, candidate), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            num += 1
+            candidate = final_name[:-4] + f'({num}).pdf'
+        else:
+            os.close(fd)
+            return candidate
+
 
 def autocorrect_match(match):
     # Remove optional space after the prefix if present
     match = match.replace(" ", "")
-    # Special case: if the string is "P0-XX-XXXX", correct it to "PO-XX-XXXX"
-    if match.startswith('P0-'):
-        return 'PO' + match[2:]
-    if match.startswith('PQ-'):
-        return 'PO' + match[2:]
-    parts = re.match(r'([A-Z]+)(\d?)-(\d{1,2})-(\d{1,4})', match)
+    # Special case: if the string is "P0-XX-XXXX" or "PQ-XX-XXXX", correct it to "PO-XX-XXXX"
+    fix = _PREFIX_FIX.get(match[:3])
+    if fix is not None:
+        return fix + match[2:]
+    parts = _PARTS_RE.match(match)
 
     if parts is not None:
         prefix = parts.group(1)
@@ -37,7 +129,81 @@ def autocorrect_match(match):
     else:
         return match
 
+
+def process_pdf(path):
+    print(f'Processing file: {path}')
+
+    # Wait until the file is fully written before processing it
+    if not wait_for_file_ready(path):
+        print(f'File still changing, processing anyway: {path}')
+
+    try:
+        # Find all occurrences of the patterns "PO-2X-XXXX", "SPO-2X-XXXX", and "RNWS-2X-XXXX" in the text,
+        # reading the PDF page by page. Matches come back autocorrected and without duplicates.
+        matches = find_matches(path)
+
+        if matches:
+            # Sort the matches list alphabetically
+            if len(matches) > 1:
+                matches.sort()
+
+            # Limit the file name length to a certain number of characters (e.g., 150 characters)
+            # 150 total minus 4 for .pdf. Only whole matches are kept, the first one always.
+            max_length = 150 - 4
+            parts = [matches[0]]
+            length = len(matches[0])
+            for match in matches[1:]:
+                if length + 1 + len(match) > max_length:
+                    break
+                parts.append(match)
+                length += 1 + len(match)
+
+            # Join the kept matches into a single string separated by underscores
+            final_name = '_'.join(parts) + '.pdf'
+
+            # Reserve a name that is not already used in the OUT folder
+            final_name = reserve_final_name(_FINAL_DIR, final_name)
+            target = _FINAL_DIR / final_name
+
+            try:
+                # Rename and move the file to the OUT folder in one step, over the placeholder
+                try:
+                    os.replace(path, target)
+                except OSError:
+                    # Different filesystem, fall back to copy and delete
+                    shutil.move(path, target)
+            except Exception:
+                # Drop the empty placeholder so the name can be used again
+                if os.path.exists(target) and os.path.getsize(target) == 0:
+                    os.remove(target)
+                raise
+
+            print(f'Processed and moved file: {final_name}')
+        else:
+            # Move the file to the NONAME folder
+            shutil.move(path, _FINAL_DIR / os.path.basename(path))
+            print(f'No pattern found, moved file to OUT folder: {path}')
+    except Exception as e:
+        print(f'Error processing file: {path}. Error: {e}')
+    # Move the file to the ERROR folder if it still exists
+    if os.path.exists(path):
+        _ERROR_DIR.mkdir(exist_ok=True)
+        shutil.move(path, _ERROR_DIR / os.path.basename(path))
+        print(f'Moved file with error to ERROR folder: {path}')
+
+
+def report_failure(path, future):
+    # process_pdf handles its own errors, anything left would otherwise be
+    # lost in the worker thread
+    if not future.cancelled() and future.exception() is not None:
+        print(f'Error processing file: {path}. Error: {future.exception()}')
+
+
 class PDFHandler(FileSystemEventHandler):
+    def __init__(self, executor):
+        super().__init__()
+        self.executor = executor
+
     def on_created(self, event):
         if event.is_directory:
             return
@@ -45,79 +211,20 @@ class PDFHandler(FileSystemEventHandler):
         # Get the path of the newly added file
         path = event.src_path
 
-        # Check if the file is a PDF
-        if path.endswith('.pdf'):
-            print(f'Processing file: {path}')
-
-            # Wait for a short time before processing the file
-            time.sleep(3)
-
-            try:
-                # Extract the text from the PDF file
-                text = extract_text(path)
-
-                # Find all occurrences of the patterns "PO-2X-XXXX", "SPO-2X-XXXX", and "RNWS-2X-XXXX" in the text
-                # matches = re.findall(r'(?:PO|SPO|RNWS)\d?-2\d-\d{4}', text)
-                matches = re.findall(r'(?:P0|PO|SPO|RNWS|SGR|SSR) ?\d?-?\d{1,2}-\d{1,4}', text, re.IGNORECASE)
-                matches = [match.upper() for match in matches]
-
-
-                if matches:
-                    # Autocorrect the matches
-                    matches = [autocorrect_match(match) for match in matches]
-
-                    # Remove duplicates from the matches list
-                    matches = list(set(matches))
-
-                    # Sort the matches list alphabetically
-                    matches.sort()
-
-                    # Join the matches list into a single string separated by underscores
-                    final_name = '_'.join(matches) + '.pdf'
-
-                    # Limit the file name length to a certain number of characters (e.g., 150 characters)
-                    # 150 total minus 4 for .pdf
-                    max_length = 150 - 4
-                    if len(final_name) > max_length:
-                        final_name = final_name[:max_length] + '.pdf'
-
-                    # Check if a file with the same name already exists in the OUT folder
-                    if os.path.exists(os.path.join('final-output', final_name)):
-                        # Get the number to add to the file name
-                        num = 1
-                        while os.path.exists(os.path.join('final-output', final_name[:-4] + f'({num}).pdf')):
-                            num += 1
-
-                        # Add the number to the file name between parenthesis
-                        final_name = final_name[:-4] + f'({num}).pdf'
-
-                    # Rename the file with the final name
-                    os.rename(path, os.path.join(os.path.dirname(path), final_name))
-
-                    # Move the renamed file to the OUT folder
-                    shutil.move(os.path.join(os.path.dirname(path), final_name), 'final-output')
-
-                    print(f'Processed and moved file: {final_name}')
-                else:
-                    # Move the file to the NONAME folder
-                    shutil.move(path, os.path.join('final-output', os.path.basename(path)))
-                    print(f'No pattern found, moved file to OUT folder: {path}')
-            except Exception as e:
-                print(f'Error processing file: {path}. Error: {e}')
-            # Move the file to the ERROR folder if it still exists
-            if os.path.exists(path):
-                if not os.path.exists('ERROR'):
-                    os.mkdir('ERROR')
-                shutil.move(path, os.path.join('ERROR', os.path.basename(path)))
-                print(f'Moved file with error to ERROR folder: {path}')
+        # Check if the file is a PDF, and process it on a worker thread so
+        # that the observer thread keeps dispatching events
+        if path.endswith(('.pdf', '.PDF')):
+            future = self.executor.submit(process_pdf, path)
+            future.add_done_callback(lambda f: report_failure(path, f))
 
 if __name__ == "__main__":
     # Enter the path of the folder to watch
     path = 'ocr-output'
 
     # Create a watchdog observer and event handler
+    executor = ThreadPoolExecutor(max_workers=WORKERS)
     observer = Observer()
-    event_handler = PDFHandler()
+    event_handler = PDFHandler(executor)
 
     # Schedule the event handler to watch for new file creations in the specified folder
     observer.schedule(event_handler, path=path, recursive=False)
@@ -132,3 +239,4 @@ if __name__ == "__main__":
         observer.stop()
     
     observer.join()
+    executor.shutdown()
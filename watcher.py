@@ -7,22 +7,24 @@ from __future__ import annotations
 
 import json
 import logging
+import multiprocessing
 import os
 import shutil
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
 
 import pikepdf
 from watchdog.events import PatternMatchingEventHandler
-from watchdog.observers import Observer
 from watchdog.observers.polling import PollingObserver
+from watchfiles import Change, watch
 
 import ocrmypdf
 
-# pylint: disable=logging-format-interpolation
-
 
 def getenv_bool(name: str, default: str = 'False'):
     return os.getenv(name, default).lower() in ('true', 'yes', 'y', '1')
@@ -40,83 +42,259 @@ POLL_NEW_FILE_SECONDS = int(os.getenv('OCR_POLL_NEW_FILE_SECONDS', '1'))
 USE_POLLING = getenv_bool('OCR_USE_POLLING')
 RETRIES_LOADING_FILE = int(os.getenv('OCR_RETRIES_LOADING_FILE', '5'))
 LOGLEVEL = os.getenv('OCR_LOGLEVEL', 'INFO')
+WORKERS = int(os.getenv('OCR_WATCHER_WORKERS', '4'))
+# Keep OCR_WATCHER_WORKERS x OCR_JOBS close to the number of CPU threads
+JOBS = int(os.getenv('OCR_JOBS', max(1, (os.cpu_count() or 1) // max(1, WORKERS))))
+# Settings that already tell ocrmypdf what to do with pages that have text
+OCR_MODE_SETTINGS = ('force_ocr', 'skip_text', 'redo_ocr')
 PATTERNS = ['*.pdf', '*.PDF']
+EXTENSIONS = ('.pdf', '.PDF')
+WATCH_STEP_MILLISECONDS = 50
+WATCH_TIMEOUT_MILLISECONDS = 1000
+
+_OUTPUT_DIR = Path(OUTPUT_DIRECTORY)
+_ARCHIVE_DIR = Path(ARCHIVE_DIRECTORY)
 
 log = logging.getLogger('ocrmypdf-watcher')
 
+# Paths currently queued or being processed, so that duplicate events for
+# the same file do not OCR it twice
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
 
 def get_output_dir(root, basename):
     if OUTPUT_DIRECTORY_YEAR_MONTH:
         today = datetime.today()
         output_directory_year_month = (
-            Path(root) / str(today.year) / f'{today.month:02d}'
+            root / str(today.year) / f'{today.month:02d}'
         )
-        if not output_directory_year_month.exists():
-            output_directory_year_month.mkdir(parents=True, exist_ok=True)
-        output_path = Path(output_directory_year_month) / basename
+        output_directory_year_month.mkdir(parents=True, exist_ok=True)
+        output_path = output_directory_year_month / basename
     else:
-        output_path = Path(OUTPUT_DIRECTORY) / basename
+        output_path = root / basename
     return output_path
 
 
+def get_file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except FileNotFoundError:
+        return -1
+
+
 def wait_for_file_ready(file_path):
     # This loop waits to make sure that the file is completely loaded on
     # disk before attempting to read. Docker sometimes will publish the
     # watchdog event before the file is actually fully on disk, causing
-    # pikepdf to fail.
+    # pikepdf to fail. A file whose size stays the same between two polls
+    # is considered written, and is then parsed by pikepdf to check it.
 
+    last_size = get_file_size(file_path)
     retries = RETRIES_LOADING_FILE
     while retries:
-        try:
-            pdf = pikepdf.open(file_path)
-        except (FileNotFoundError, pikepdf.PdfError) as e:
-            log.info(f"File {file_path} is not ready yet")
-            log.debug("Exception was", exc_info=e)
-            time.sleep(POLL_NEW_FILE_SECONDS)
-            retries -= 1
+        time.sleep(POLL_NEW_FILE_SECONDS)
+        retries -= 1
+        size = get_file_size(file_path)
+        if size > 0 and size == last_size:
+            try:
+                pdf = pikepdf.open(file_path)
+            except (FileNotFoundError, pikepdf.PdfError) as e:
+                # The writer may only have paused, keep polling
+                log.info("File %s is not ready yet", file_path)
+                log.debug("Exception was", exc_info=e)
+            else:
+                pdf.close()
+                return True
         else:
-            pdf.close()
-            return True
+            log.debug("File %s is not ready yet", file_path)
+        last_size = size
 
     return False
 
 
 def execute_ocrmypdf(file_path):
     file_path = Path(file_path)
-    output_path = get_output_dir(OUTPUT_DIRECTORY, file_path.name)
+    output_path = get_output_dir(_OUTPUT_DIR, file_path.name)
 
     log.info("-" * 20)
-    log.info(f'New file: {file_path}. Waiting until fully loaded...')
+    log.info('New file: %s. Waiting until fully loaded...', file_path)
     if not wait_for_file_ready(file_path):
-        log.info(f"Gave up waiting for {file_path} to become ready")
+        log.info("Gave up waiting for %s to become ready", file_path)
         return
-    log.info(f'Attempting to OCRmyPDF to: {output_path}')
+    log.info('Attempting to OCRmyPDF to: %s', output_path)
+    # Plain PDF output without image optimization skips the Ghostscript
+    # post-processing, OCR_JSON_SETTINGS can still ask for PDF/A
+    settings = {'jobs': JOBS, 'output_type': 'pdf', 'optimize': 0, **OCR_JSON_SETTINGS}
+    # Unless told otherwise, leave pages that already have text as they are
+    # and OCR the others, instead of failing on PDFs with a text layer
+    if not any(settings.get(key) for key in OCR_MODE_SETTINGS):
+        settings.setdefault('skip_text', True)
     exit_code = ocrmypdf.ocr(
         input_file=file_path,
         output_file=output_path,
         deskew=DESKEW,
-        **OCR_JSON_SETTINGS,
+        **settings,
     )
     if exit_code == 0:
         if ON_SUCCESS_DELETE:
-            log.info(f'OCR is done. Deleting: {file_path}')
+            log.info('OCR is done. Deleting: %s', file_path)
             file_path.unlink()
         elif ON_SUCCESS_ARCHIVE:
-            log.info(f'OCR is done. Archiving {file_path.name} to {ARCHIVE_DIRECTORY}')
-            shutil.move(file_path, f'{ARCHIVE_DIRECTORY}/{file_path.name}')
+            log.info('OCR is done. Archiving %s to %s', file_path.name, ARCHIVE_DIRECTORY)
+            shutil.move(file_path, _ARCHIVE_DIR / file_path.name)
         else:
             log.info('OCR is done')
     else:
         log.info('OCR is done')
 
 
+def process_one(file_path):
+    # Runs in a worker process
+    try:
+        execute_ocrmypdf(file_path)
+    except Exception as e:
+        log.error('Error processing %s: %s', file_path, e)
+        log.debug("Exception was", exc_info=e)
+
+
+def release_file(file_path):
+    with _in_flight_lock:
+        _in_flight.discard(file_path)
+
+
+def on_file_done(file_path, future):
+    release_file(file_path)
+    # process_one handles its own errors, anything left comes from the pool
+    if not future.cancelled() and future.exception() is not None:
+        log.error('OCR worker for %s failed: %s', file_path, future.exception())
+
+
+class OcrWorkerPool:
+    # ProcessPoolExecutor that is replaced when one of its workers dies
+    # (OOM killer, native crash), since a broken pool refuses all new work
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = self._create_executor()
+
+    @staticmethod
+    def _create_executor():
+        # ocrmypdf.ocr() sets up process-wide logging and worker pools, so
+        # concurrent files run in separate worker processes rather than
+        # threads. Workers are spawned rather than forked from this
+        # multi-threaded process, and set up logging again on start.
+        return ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_logging,
+        )
+
+    def submit(self, fn, *args):
+        with self._lock:
+            try:
+                return self._executor.submit(fn, *args)
+            except BrokenProcessPool:
+                log.error('An OCR worker died, restarting the worker pool')
+                self._executor.shutdown(wait=False)
+                self._executor = self._create_executor()
+                return self._executor.submit(fn, *args)
+
+    def shutdown(self):
+        with self._lock:
+            self._executor.shutdown()
+
+
+def submit_file(executor, file_path):
+    # Events and the startup scan report the same file as absolute and
+    # relative paths, use one form so that they are deduplicated
+    file_path = os.path.abspath(file_path)
+    with _in_flight_lock:
+        if file_path in _in_flight:
+            log.debug('%s is already being processed', file_path)
+            return
+        _in_flight.add(file_path)
+    try:
+        future = executor.submit(process_one, file_path)
+    except Exception:
+        release_file(file_path)
+        raise
+    future.add_done_callback(lambda f: on_file_done(file_path, f))
+
+
+def submit_existing_files(executor, directory):
+    # Files that were already there when the watcher started never produce
+    # an event, queue them like new ones
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                submit_existing_files(executor, entry.path)
+            elif entry.is_file() and entry.name.endswith(EXTENSIONS):
+                submit_file(executor, entry.path)
+
+
+def reconcile_input_directory(executor):
+    # Inputs are only removed after OCR when deleting or archiving them,
+    # otherwise every restart would OCR the whole input history again
+    if not (ON_SUCCESS_DELETE or ON_SUCCESS_ARCHIVE):
+        log.info('Not processing files already in %s', INPUT_DIRECTORY)
+        return
+    submit_existing_files(executor, INPUT_DIRECTORY)
+
+
 class HandleObserverEvent(PatternMatchingEventHandler):
+    def __init__(self, executor, **kwargs):
+        super().__init__(**kwargs)
+        self.executor = executor
+
     def on_any_event(self, event):
-        if event.event_type in ['created']:
-            execute_ocrmypdf(event.src_path)
+        if event.event_type == 'created':
+            submit_file(self.executor, event.src_path)
 
 
-def main():
+def pdf_added_filter(change, path):
+    return change == Change.added and path.endswith(EXTENSIONS)
+
+
+def watch_polling(executor):
+    handler = HandleObserverEvent(executor, patterns=PATTERNS)
+    observer = PollingObserver()
+    observer.schedule(handler, INPUT_DIRECTORY, recursive=True)
+    observer.start()
+    reconcile_input_directory(executor)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+
+
+def watch_events(executor):
+    # watchfiles blocks on native filesystem notifications and yields
+    # batches of changes, so no sleep loop is needed here. It only starts
+    # watching on the first iteration, which also yields on timeout, so
+    # files already there are queued once changes can no longer be missed.
+    reconciled = False
+    try:
+        for changes in watch(
+            INPUT_DIRECTORY,
+            watch_filter=pdf_added_filter,
+            recursive=True,
+            step=WATCH_STEP_MILLISECONDS,
+            rust_timeout=WATCH_TIMEOUT_MILLISECONDS,
+            yield_on_timeout=True,
+        ):
+            if not reconciled:
+                reconcile_input_directory(executor)
+                reconciled = True
+            for _, path in changes:
+                submit_file(executor, path)
+    except KeyboardInterrupt:
+        pass
+
+
+def configure_logging():
     ocrmypdf.configure_logging(
         verbosity=(
             ocrmypdf.Verbosity.default
@@ -126,45 +304,68 @@ def main():
         manage_root_logger=True,
     )
     log.setLevel(LOGLEVEL)
+
+
+def main():
+    configure_logging()
     log.info(
-        f"Starting OCRmyPDF watcher with config:\n"
-        f"Input Directory: {INPUT_DIRECTORY}\n"
-        f"Output Directory: {OUTPUT_DIRECTORY}\n"
-        f"Output Directory Year & Month: {OUTPUT_DIRECTORY_YEAR_MONTH}\n"
-        f"Archive Directory: {ARCHIVE_DIRECTORY}"
+        "Starting OCRmyPDF watcher with config:\n"
+        "Input Directory: %s\n"
+        "Output Directory: %s\n"
+        "Output Directory Year & Month: %s\n"
+        "Archive Directory: %s",
+        INPUT_DIRECTORY,
+        OUTPUT_DIRECTORY,
+        OUTPUT_DIRECTORY_YEAR_MONTH,
+        ARCHIVE_DIRECTORY,
     )
     log.debug(
-        f"INPUT_DIRECTORY: {INPUT_DIRECTORY}\n"
-        f"OUTPUT_DIRECTORY: {OUTPUT_DIRECTORY}\n"
-        f"OUTPUT_DIRECTORY_YEAR_MONTH: {OUTPUT_DIRECTORY_YEAR_MONTH}\n"
-        f"ARCHIVE_DIRECTORY: {ARCHIVE_DIRECTORY}\n"
-        f"ON_SUCCESS_DELETE: {ON_SUCCESS_DELETE}\n"
-        f"ON_SUCCESS_ARCHIVE: {ON_SUCCESS_ARCHIVE}\n"
-        f"DESKEW: {DESKEW}\n"
-        f"ARGS: {OCR_JSON_SETTINGS}\n"
-        f"POLL_NEW_FILE_SECONDS: {POLL_NEW_FILE_SECONDS}\n"
-        f"RETRIES_LOADING_FILE: {RETRIES_LOADING_FILE}\n"
-        f"USE_POLLING: {USE_POLLING}\n"
-        f"LOGLEVEL: {LOGLEVEL}"
+        "INPUT_DIRECTORY: %s\n"
+        "OUTPUT_DIRECTORY: %s\n"
+        "OUTPUT_DIRECTORY_YEAR_MONTH: %s\n"
+        "ARCHIVE_DIRECTORY: %s\n"
+        "ON_SUCCESS_DELETE: %s\n"
+        "ON_SUCCESS_ARCHIVE: %s\n"
+        "DESKEW: %s\n"
+        "ARGS: %s\n"
+        "POLL_NEW_FILE_SECONDS: %s\n"
+        "RETRIES_LOADING_FILE: %s\n"
+        "USE_POLLING: %s\n"
+        "WORKERS: %s\n"
+        "JOBS: %s\n"
+        "LOGLEVEL: %s",
+        INPUT_DIRECTORY,
+        OUTPUT_DIRECTORY,
+        OUTPUT_DIRECTORY_YEAR_MONTH,
+        ARCHIVE_DIRECTORY,
+        ON_SUCCESS_DELETE,
+        ON_SUCCESS_ARCHIVE,
+        DESKEW,
+        OCR_JSON_SETTINGS,
+        POLL_NEW_FILE_SECONDS,
+        RETRIES_LOADING_FILE,
+        USE_POLLING,
+        WORKERS,
+        JOBS,
+        LOGLEVEL,
     )
 
     if 'input_file' in OCR_JSON_SETTINGS or 'output_file' in OCR_JSON_SETTINGS:
         log.error('OCR_JSON_SETTINGS should not specify input file or output file')
         sys.exit(1)
 
-    handler = HandleObserverEvent(patterns=PATTERNS)
-    if USE_POLLING:
-        observer = PollingObserver()
-    else:
-        observer = Observer()
-    observer.schedule(handler, INPUT_DIRECTORY, recursive=True)
-    observer.start()
+    if WORKERS < 1 or JOBS < 1:
+        log.error('OCR_WATCHER_WORKERS and OCR_JOBS should be at least 1')
+        sys.exit(1)
+
+    executor = OcrWorkerPool()
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        if USE_POLLING:
+            watch_polling(executor)
+        else:
+            watch_events(executor)
+    finally:
+        executor.shutdown()
 
 
 if __name__ == "__main__":